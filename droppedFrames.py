@@ -12,17 +12,22 @@ from the command line (see the commandLine function for more details).
 
 # System imports
 import os
+import re
 import sys
-import glob
-import shutil
+import json
 import logging
 import smtplib
 import configparser
-from statistics import mean
+from fnmatch import fnmatchcase
+from pathlib import Path
 from email.message import EmailMessage
 from datetime import datetime, timedelta
 from importlib import import_module as impmod
 from PIL import Image, ImageFont, ImageDraw
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 # RMS imports
 import RMS.ConfigReader as cr
@@ -51,6 +56,11 @@ DROPPED_FRAME_TDELTA = timedelta(seconds=15)
 EMAIL_RESULTS = False
 EMAIL_FRAMES = 1
 
+# Set EMAIL_ATTACHMENT_LIMIT to the maximum total size (in bytes) of
+# images attached to an email. Gmail limits messages to 25MB, and
+# attachments grow by about a third when encoded.
+EMAIL_ATTACHMENT_LIMIT = 18 * 1024 * 1024
+
 # EXPERIMENTAL
 # Set ANNOTATE_IMAGE to True if you want a detected stack image
 # to be annotated with the number of dropped frames when they
@@ -58,6 +68,17 @@ EMAIL_FRAMES = 1
 ANNOTATE_IMAGE = False
 ANNOTATE_IMAGE_FRAMES = 5
 
+# Set DROPPED_CACHE_FILE to the file used to store results between runs,
+# so that unchanged directories are not rescanned
+DROPPED_CACHE_FILE = os.path.expanduser('~/.ukmon/dropped_cache.json')
+
+# FF filename format, eg. FF_UK0001_20230101_203015_123_0123456.fits
+_FF_RE = re.compile(r'^FF_.{6}_\d{8}_\d{6}_')
+
+# Font used to annotate images (loaded on first use)
+_FNT = None
+_FNT_HEIGHT = 20
+
 
 def rmsExternal(cap_dir, arch_dir, config):
     """
@@ -93,7 +114,8 @@ def rmsExternal(cap_dir, arch_dir, config):
     log.info('checking for dropped frames on %s', str(config.stationID))
 
     # Check for dropped frames
-    results = checkDroppedFrames(cap_dir)
+    since, until = _session_date_range(cap_dir)
+    results = checkDroppedFrames(cap_dir, since=since, until=until)
 
     # Log the results
     log.info('analysed %i FF files', results["files analysed"])
@@ -103,10 +125,9 @@ def rmsExternal(cap_dir, arch_dir, config):
     if results["dropped frames"] == 0:
         log.info('no dropped frames detected')
     else:
-        log.info('found %i FF files with a time gap of more than %s seconds:',
-                 results["dropped frames"], str(DROPPED_FRAME_TDELTA.seconds))
-        for detail in results["dropped details"]:
-            log.info('    %s', detail)
+        log.info('found %i FF files with a time gap of more than %s seconds:\n%s',
+                 results["dropped frames"], str(DROPPED_FRAME_TDELTA.seconds),
+                 '\n'.join('    ' + detail for detail in results["dropped details"]))
 
     # Send warning email with # dropped frames
     if EMAIL_RESULTS and results["dropped frames"] >= EMAIL_FRAMES:
@@ -114,40 +135,43 @@ def rmsExternal(cap_dir, arch_dir, config):
         subject = 'Dropped frames for {}'.format(config.stationID)
         message = ('Found {} FF files with a time gap of more than {} seconds\n\n'.format(
                 results["dropped frames"], str(DROPPED_FRAME_TDELTA.seconds)))
-        for detail in results["dropped details"]:
-            message += '  {}\n'.format(detail)
+        message += ''.join('  {}\n'.format(detail) for detail in results["dropped details"])
         log.info(sendEmail(subject, message))
 
     # Annotate image with # dropped frams
     if ANNOTATE_IMAGE and results["dropped frames"] >= ANNOTATE_IMAGE_FRAMES:
         log.info('annotating images')
+        if results["dropped frames"] == 0:
+            message = 'No dropped frames detected'
+        else:
+            if results["dropped frames"] == 1:
+                inner_msg = ' detected ('
+            else:
+                inner_msg = 's detected (average '
+            message = '{} dropped frame{}{} seconds)'.format(results["dropped frames"], inner_msg, results["dropped average"])
         for directory in [cap_dir, arch_dir]:
-            files = glob.glob(
-                directory + '/' + os.path.basename(directory) + '_stack*meteors.jpg')
-            for original_file in files:
-                # TODO: After testing, remove code that copies original image
-                # ie. just make the annotation on the original image
-                new_file = original_file.replace(
-                    '.jpg', '_'+str(results["dropped frames"])+'_droppedframes.jpg')
-                shutil.copy(original_file, new_file)
-                if results["dropped frames"] == 0:
-                    message = 'No dropped frames detected'
-                else:
-                    if results["dropped frames"] == 1:
-                        inner_msg = ' detected ('
-                    else:
-                        inner_msg = 's detected (average '
-                    message = '{} dropped frame{}{}{} seconds)'.format(results["dropped frames"], inner_msg, results["dropped average"])
-                annotateImage(new_file, message)
+            directory = Path(directory)
+            for original_file in directory.glob(directory.name + '_stack*meteors.jpg'):
+                new_file = original_file.with_name(
+                    original_file.stem + '_'+str(results["dropped frames"])+'_droppedframes.jpg')
+                annotateImage(original_file, new_file, message)
                 log.info('annotated image: %s', new_file)
 
-    # Send email with main images
-    email_attachments = []
-    email_attachments.extend(glob.glob(os.path.join(cap_dir, "*_droppedframes.jpg")))
-    email_attachments.extend(glob.glob(os.path.join(cap_dir, "*_stack*meteors.jpg")))
-    email_attachments.extend(glob.glob(os.path.join(cap_dir, "*captured_stack.jpg")))
-    email_attachments.extend(glob.glob(os.path.join(cap_dir, "*DETECTED_thumbs.jpg")))
-    email_attachments.extend(glob.glob(os.path.join(cap_dir, "*CAPTURED_thumbs.jpg")))
+    # Send email with main images (matched in a single directory pass and
+    # ordered by pattern)
+    patterns = ("*_droppedframes.jpg", "*_stack*meteors.jpg", "*captured_stack.jpg",
+                "*DETECTED_thumbs.jpg", "*CAPTURED_thumbs.jpg")
+    matches = []
+    try:
+        with os.scandir(cap_dir) as it:
+            for entry in it:
+                for i, pattern in enumerate(patterns):
+                    if fnmatchcase(entry.name, pattern):
+                        matches.append((i, entry.path))
+                        break
+    except OSError:
+        pass
+    email_attachments = [path for _, path in sorted(matches)]
     for file in email_attachments:
         log.info('image: %s', str(file))
     log.info(sendEmail(email_subject='{}'.format(config.stationID),
@@ -159,17 +183,23 @@ def rmsExternal(cap_dir, arch_dir, config):
 
     # Test for additional script
     log.info('about to test for extra script')
-    try:
-        with open(os.path.join(srcdir, 'extrascript'), 'r') as extraf:
-            extrascript = extraf.readline().strip()
-        log.info('running additional script {:s}'.format(extrascript))
-        log = clearLogHandlers()
-        sloc, sname = os.path.split(extrascript)
-        sys.path.append(sloc)
-        scrname, _ = os.path.splitext(sname)
-        nextscr = impmod(scrname)
-        nextscr.rmsExternal(cap_dir, arch_dir, config)
-    except (IOError, OSError):
+    extrascript_path = os.path.join(srcdir, 'extrascript')
+    extrascript_called = False
+    if os.path.exists(extrascript_path):
+        try:
+            with open(extrascript_path, 'r') as extraf:
+                extrascript = extraf.readline().strip()
+            log.info('running additional script {:s}'.format(extrascript))
+            log = clearLogHandlers()
+            sloc, sname = os.path.split(extrascript)
+            sys.path.append(sloc)
+            scrname, _ = os.path.splitext(sname)
+            nextscr = impmod(scrname)
+            nextscr.rmsExternal(cap_dir, arch_dir, config)
+            extrascript_called = True
+        except OSError:
+            pass
+    if not extrascript_called:
         log.info('additional script not called')
         try:
             log.info('removing rebootlockfile')
@@ -210,13 +240,31 @@ def sendEmail(email_subject='No subject',
     msg['From'] = email_from
     msg['To'] = email_to
     msg['Subject'] = email_subject
+
+    # Select email attachments up to EMAIL_ATTACHMENT_LIMIT bytes in total
+    # (checked from file sizes so that oversized files are never read) and
+    # list any remaining files by path in the email content instead
+    attached = []
+    not_attached = []
+    total_size = 0
+    for file in email_attachments:
+        size = os.path.getsize(file)
+        if total_size + size <= EMAIL_ATTACHMENT_LIMIT:
+            attached.append(file)
+            total_size += size
+        else:
+            not_attached.append(file)
+    if not_attached:
+        email_content += '\n\nFiles not attached (size limit exceeded):\n'
+        for file in not_attached:
+            email_content += '  {}\n'.format(file)
     msg.set_content(email_content)
 
     # Add email attachments
-    for file in email_attachments:
+    for file in attached:
         with open(file, 'rb') as fp:
-            img_data = fp.read()
-        msg.add_attachment(img_data, maintype='image', subtype='jpg')
+            msg.add_attachment(fp.read(), maintype='image', subtype='jpeg',
+                               filename=os.path.basename(file))
 
     # Send email
     with smtplib.SMTP_SSL('smtp.gmail.com', 465) as smtp:
@@ -226,24 +274,34 @@ def sendEmail(email_subject='No subject',
     return 'email sent to {}'.format(email_to)
 
 
-def annotateImage(img_path, message):
-    """Function to annotate an image with the number of dropped frames."""
-    my_image = Image.open(img_path)
+def annotateImage(in_path, out_path, message):
+    """
+    Function to annotate an image with the number of dropped frames. The
+    annotated image is saved to out_path, leaving the original unchanged.
+    """
+    my_image = Image.open(in_path)
     width, height = my_image.size
     image_editable = ImageDraw.Draw(my_image)
-    fntheight = 20
-    try:
-        fnt = ImageFont.truetype("arial.ttf", fntheight)
-    except:
-        fnt = ImageFont.truetype("DejaVuSans.ttf", fntheight)
-    # fnt = ImageFont.load_default()
-    width_text, _ = image_editable.textsize(message, fnt)
-    offset_x, _ = fnt.getoffset(message)
-    width_text += offset_x
+    fntheight = _FNT_HEIGHT
+    fnt = _get_font()
+    left, _, right, _ = image_editable.textbbox((0, 0), message, font=fnt)
+    width_text = right - left
     top_left_x = width / 2 - width_text / 2
     image_editable.text((top_left_x, height-fntheight-15),
                         message, font=fnt, fill=(255))
-    my_image.save(img_path)
+    my_image.save(out_path)
+
+
+def _get_font():
+    """Function to load the annotation font once and reuse it thereafter."""
+    global _FNT
+    if _FNT is None:
+        try:
+            _FNT = ImageFont.truetype("arial.ttf", _FNT_HEIGHT)
+        except OSError:
+            _FNT = ImageFont.truetype("DejaVuSans.ttf", _FNT_HEIGHT)
+        # _FNT = ImageFont.load_default()
+    return _FNT
 
 
 def commandLine():
@@ -257,12 +315,25 @@ def commandLine():
     path = '/home/pi/RMS_data/CapturedFiles'
     # path = '/Users/david/UK9999/CapturedFiles'
     total_files = 0
+    cache = loadCache()
 
-    # Loop through all directories in the given path
-    for directory, _, _ in sorted(os.walk(path)):
+    # List capture directories (these are one level below the given path)
+    try:
+        with os.scandir(path) as it:
+            directories = [os.path.join(path, name) for name in
+                           sorted(e.name for e in it if e.is_dir())]
+    except OSError:
+        # Leave the cache untouched if the path is unavailable
+        print()
+        print('No FF files found in {}'.format(path))
+        print()
+        return
+
+    # Loop through all capture directories
+    for directory in directories:
 
         # Check directory for dropped frames
-        results = checkDroppedFrames(directory)
+        results = checkDroppedFrames(directory, cache=cache)
 
         # Print results for current directory
         if results["files analysed"] > 0:
@@ -279,69 +350,196 @@ def commandLine():
                 if results["dropped frames"] >= 0:
                     print('{:9,} FF files found with a time gap of more than {} seconds:'.format(
                         results["dropped frames"], str(DROPPED_FRAME_TDELTA.seconds)))
-                    for detail in results["dropped details"]:
-                        print('            {}'.format(detail))
+                    if results["dropped details"]:
+                        print('\n'.join('            ' + detail for detail in results["dropped details"]))
                 total_files += results["files analysed"]
 
-    # Finish
+    # Finish (dropping cached results for directories that no longer exist)
+    for directory in set(cache) - set(directories):
+        del cache[directory]
+    saveCache(cache)
     if total_files == 0:
         print()
         print('No FF files found in {}'.format(path))
     print()
 
 
-def checkDroppedFrames(directory):
+def checkDroppedFrames(directory, since=None, until=None, cache=None):
     """
     Function to check a directory for dropped frames, ie. FF files with
     a time gap of more than {DROPPED_FRAME_TDELTA} seconds.
+
+    If since and/or until are given (as 'YYYYMMDD' strings), valid FF files
+    dated outside that range are skipped without being parsed. Malformed
+    filenames are still counted as ignored.
+
+    If a cache dict is given (see loadCache), results are reused while the
+    directory's mtime is unchanged, so directories still being captured
+    are always rescanned.
     """
 
+    # Return cached results if the directory has not changed
+    if cache is not None:
+        try:
+            mtime = os.stat(directory).st_mtime
+        except OSError:
+            mtime = None
+        entry = cache.get(directory)
+        if (isinstance(entry, dict) and mtime is not None
+                and entry.get('mtime') == mtime
+                and entry.get('since') == since and entry.get('until') == until
+                and entry.get('tdelta') == DROPPED_FRAME_TDELTA.seconds
+                and isinstance(entry.get('results'), dict)):
+            return entry['results']
+
     # Initialise variables
-    files_analysed = 0
     files_ignored = 0
-    dropped_frames = 0
-    dropped_times = []
     dropped_average = 0
-    dropped_details = []
-    previous_dt = None
-    tdelta = timedelta(seconds=0)
 
-    # Loop through all FF files
-    for file in sorted(glob.glob(directory + '/*.fits')):
-        fname = os.path.basename(file)
-        try:
-            # Extract datetime from FF filename
-            current_dt = datetime.strptime(fname[10:25], '%Y%m%d_%H%M%S')
-        except ValueError:
+    # Extract timestamps from FF filenames
+    stamps = []
+    for stamp in _iter_ff_timestamps(directory, since, until):
+        if stamp is None:
             # Unrecognised FF filename format
             files_ignored += 1
             continue
+        stamps.append(stamp)
+
+    # Find FF files with a time gap of more than DROPPED_FRAME_TDELTA
+    # from the previous FF file, vectorised with numpy where available.
+    # The array is built from ISO strings, as converting datetime objects
+    # is much slower than the plain Python comparison.
+    ts = None
+    if np is not None:
+        try:
+            ts = np.array(['{}-{}-{}T{}:{}:{}'.format(
+                s[0:4], s[4:6], s[6:8], s[9:11], s[11:13], s[13:15])
+                for s in stamps], dtype='datetime64[s]')
+        except ValueError:
+            # Impossible date (eg. 20230230), use the scalar path below
+            ts = None
+        if ts is not None and ts.size and ts.min() < np.datetime64('0001-01-01'):
+            # Year 0000 is valid for numpy but not for datetime, so also
+            # use the scalar path (which ignores it) to keep results the same
+            ts = None
+    if ts is not None:
+        files_analysed = len(stamps)
+        deltas_sec = np.diff(ts).astype('int64')
+        mask = deltas_sec > DROPPED_FRAME_TDELTA.total_seconds()
+        gaps = np.flatnonzero(mask).tolist()
+        dropped_times = deltas_sec[mask].tolist()
+        if dropped_times:
+            dropped_average = int(deltas_sec[mask].mean())
+        gap_pairs = [(_parse_ff_timestamp(stamps[i]), _parse_ff_timestamp(stamps[i + 1]))
+                     for i in gaps]
+    else:
+        datetimes = []
+        for stamp in stamps:
+            current_dt = _parse_ff_timestamp(stamp)
+            if current_dt is None:
+                files_ignored += 1
+                continue
+            datetimes.append(current_dt)
+        files_analysed = len(datetimes)
+        gaps = [i for i in range(files_analysed - 1)
+                if datetimes[i + 1] - datetimes[i] > DROPPED_FRAME_TDELTA]
+        dropped_times = [int((datetimes[i + 1] - datetimes[i]).total_seconds())
+                         for i in gaps]
+        if dropped_times:
+            dropped_average = sum(dropped_times) // len(dropped_times)
+        gap_pairs = [(datetimes[i], datetimes[i + 1]) for i in gaps]
+
+    # Format details of dropped frames
+    dropped_frames = len(gaps)
+    dropped_details = [
+        previous_dt.strftime('%d-%b-%Y %H:%M:%S') + ' → ' +
+        current_dt.strftime('%d-%b-%Y %H:%M:%S') + ' = ' +
+        str(seconds) + ' seconds'
+        for (previous_dt, current_dt), seconds in zip(gap_pairs, dropped_times)]
+
+    # Return results (and store them in the cache)
+    results = {'files analysed': files_analysed,
+               'files ignored': files_ignored,
+               'dropped frames': dropped_frames,
+               'dropped average': dropped_average,
+               'dropped details': dropped_details}
+    if cache is not None and mtime is not None:
+        cache[directory] = {'mtime': mtime, 'since': since, 'until': until,
+                            'tdelta': DROPPED_FRAME_TDELTA.seconds,
+                            'results': results}
+    return results
+
+
+def loadCache():
+    """Function to load cached dropped frame results from DROPPED_CACHE_FILE"""
+    try:
+        with open(DROPPED_CACHE_FILE, 'r') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+
+def saveCache(cache):
+    """Function to save cached dropped frame results to DROPPED_CACHE_FILE"""
+    try:
+        os.makedirs(os.path.dirname(DROPPED_CACHE_FILE), exist_ok=True)
+        with open(DROPPED_CACHE_FILE, 'w') as f:
+            json.dump(cache, f)
+    except OSError:
+        pass
+
+
+def _session_date_range(cap_dir):
+    """
+    Function to derive the range of FF file dates for a capture session
+    from its directory name, eg. UK0001_20230101_201530_123456. A session
+    runs overnight, so the range covers its start date and the day after.
+    Returns (None, None) if the directory name is not in the expected format.
+    """
+    parts = os.path.basename(os.path.normpath(cap_dir)).split('_')
+    try:
+        start = datetime(int(parts[1][0:4]), int(parts[1][4:6]), int(parts[1][6:8]))
+    except (ValueError, IndexError):
+        return None, None
+    return start.strftime('%Y%m%d'), (start + timedelta(days=1)).strftime('%Y%m%d')
+
+
+def _iter_ff_timestamps(directory, since=None, until=None):
+    """
+    Generator yielding the 'YYYYMMDD_HHMMSS' timestamp of each FF file in a
+    directory, in filename order, or None if the filename is not in the
+    expected format. FF files dated outside since/until are skipped.
+    """
+    # List FF filenames (basenames only, as the full path is not needed)
+    try:
+        with os.scandir(directory) as it:
+            names = sorted(e.name for e in it if e.name.endswith('.fits'))
+    except OSError:
+        return
+
+    for fname in names:
+        if _FF_RE.match(fname) is None:
+            yield None
+            continue
+        # Skip valid FF files outside the requested date range
+        if (since and fname[10:18] < since) or (until and fname[10:18] > until):
+            continue
+        yield fname[10:25]
+
 
-        # Check timedelta from previous FF file
-        if previous_dt:
-            tdelta = current_dt - previous_dt
-            if tdelta > DROPPED_FRAME_TDELTA:
-                dropped_frames += 1
-                dropped_times.append(tdelta.seconds)
-                dropped_details.append(
-                    previous_dt.strftime('%d-%b-%Y %H:%M:%S') + ' → ' +
-                    current_dt.strftime('%d-%b-%Y %H:%M:%S') + ' = ' +
-                    str(tdelta.seconds) + ' seconds')
-
-        # Update working variables
-        files_analysed += 1
-        previous_dt = current_dt
-
-    # Calculate average duration of dropped frames
-    if dropped_frames != 0:
-        dropped_average = int(mean(dropped_times))
-
-    # Return results
-    return {'files analysed': files_analysed,
-            'files ignored': files_ignored,
-            'dropped frames': dropped_frames,
-            'dropped average': dropped_average,
-            'dropped details': dropped_details}
+def _parse_ff_timestamp(stamp):
+    """
+    Function to convert a 'YYYYMMDD_HHMMSS' timestamp (already validated
+    by _FF_RE) to a datetime. The fixed positions are sliced directly,
+    which is much faster than strptime. Returns None for impossible dates,
+    eg. 20230230.
+    """
+    try:
+        return datetime(int(stamp[0:4]), int(stamp[4:6]), int(stamp[6:8]),
+                        int(stamp[9:11]), int(stamp[11:13]), int(stamp[13:15]))
+    except ValueError:
+        return None
 
 
 if __name__ == '__main__':